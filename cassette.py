@@ -0,0 +1,216 @@
+import json
+import time
+import base64
+import threading
+import logging
+import requests
+from urllib.parse import urlsplit
+from requests.structures import CaseInsensitiveDict
+
+
+CASSETTE_VERSION = 2
+
+
+logger = logging.getLogger('cassette')
+
+
+def get_interaction_key(method, url, json_data=None, data=None):
+    """ Get the key identifying a request in a cassette
+
+        The host of the URL is not part of the key, as the NyaaTorrent mirror a
+        search is sent to depends on the latencies measured during the run.
+
+        Args:
+            method (str): HTTP method of the request.
+            url (str): URL of the request.
+            json_data: JSON body of the request.
+            data: raw body of the request.
+
+        Returns:
+            (str): key of the request.
+    """
+    if json_data is not None:
+        body = json.dumps(json_data, sort_keys=True)
+
+    elif data is not None:
+        body = str(data)
+
+    else:
+        body = ''
+
+    url = urlsplit(url)
+    path = url.path
+    if url.query:
+        path += '?' + url.query
+
+    return '{} {} {}'.format(method.upper(), path, body)
+
+
+class RecordingSession(requests.Session):
+    """ Class for an HTTP session recording its interactions in a cassette
+
+        Responses are read entirely when recorded, so streamed responses are
+        not streamed anymore.
+
+        Attributes:
+            path (str): Path to the cassette file.
+            interactions (list): Interactions recorded so far.
+            lock (threading.Lock): Lock for the interactions, as requests may
+                be sent from other threads.
+
+        Args:
+            path (str): Path to the cassette file.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.interactions = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        key = get_interaction_key(
+                method,
+                url,
+                kwargs.get('json'),
+                kwargs.get('data')
+                )
+
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, **kwargs)
+            # read the whole content now, so it is part of the latency
+            content = response.content
+
+        except requests.exceptions.RequestException as error:
+            self._record({
+                'key': key,
+                'elapsed': time.monotonic() - start,
+                'error': str(error),
+                })
+
+            raise
+
+        self._record({
+            'key': key,
+            'elapsed': time.monotonic() - start,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'url': response.url,
+            'headers': dict(response.headers),
+            'encoding': response.encoding,
+            'content': base64.b64encode(content).decode('ascii'),
+            })
+
+        return response
+
+    def _record(self, interaction):
+        """ Record an interaction
+
+            Args:
+                interaction (dict): Interaction to record.
+        """
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def save(self):
+        """ Write the cassette file
+        """
+        with self.lock:
+            cassette = {
+                    'version': CASSETTE_VERSION,
+                    'interactions': list(self.interactions),
+                    }
+
+        with open(self.path, 'w') as file:
+            json.dump(cassette, file, indent=1)
+
+        logger.info("Recorded {} HTTP interactions in '{}'".format(
+            len(cassette['interactions']),
+            self.path
+            ))
+
+
+class ReplayingSession(requests.Session):
+    """ Class for an HTTP session replaying interactions from a cassette
+
+        Identical requests are answered in the order they were recorded, no
+        request is sent on the network. Requests are identified regardless of
+        their host, so a search sent to another mirror than during the
+        recording is still answered.
+
+        Attributes:
+            interactions (dict): Interactions not replayed yet, by request key.
+            latency (bool): Flag to wait for the recorded latency before
+                answering.
+            lock (threading.Lock): Lock for the interactions, as requests may
+                be sent from other threads.
+
+        Args:
+            path (str): Path to the cassette file.
+            latency (bool): Flag to wait for the recorded latency before
+                answering. Set to `False` by default.
+    """
+
+    def __init__(self, path, latency=False):
+        super().__init__()
+        self.latency = latency
+        self.lock = threading.Lock()
+
+        with open(path) as file:
+            cassette = json.load(file)
+
+        if cassette.get('version') != CASSETTE_VERSION:
+            raise CassetteError("Unsupported cassette version in '{}'".format(
+                path
+                ))
+
+        self.interactions = {}
+        for interaction in cassette['interactions']:
+            self.interactions.setdefault(interaction['key'], []).append(
+                    interaction
+                    )
+
+        logger.debug("Loaded {} HTTP interactions from '{}'".format(
+            len(cassette['interactions']),
+            path
+            ))
+
+    def request(self, method, url, **kwargs):
+        key = get_interaction_key(
+                method,
+                url,
+                kwargs.get('json'),
+                kwargs.get('data')
+                )
+
+        with self.lock:
+            interactions = self.interactions.get(key)
+            if not interactions:
+                raise CassetteError("Request not found in cassette: '{}'".format(
+                    key
+                    ))
+
+            interaction = interactions.pop(0)
+
+        if self.latency:
+            time.sleep(interaction['elapsed'])
+
+        if 'error' in interaction:
+            raise requests.exceptions.ConnectionError(interaction['error'])
+
+        response = requests.Response()
+        response.status_code = interaction['status_code']
+        response.reason = interaction['reason']
+        response.url = interaction['url']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.encoding = interaction['encoding']
+        response._content = base64.b64decode(interaction['content'])
+        response._content_consumed = True
+
+        return response
+
+
+class CassetteError(Exception):
+    """ Class for cassette errors
+    """
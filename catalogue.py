@@ -0,0 +1,201 @@
+import re
+import sqlite3
+import logging
+
+
+REGEX_WORD = r'[^\W_]+'
+REGEX_PLACEHOLDER = r'\{\w+\}'
+
+
+logger = logging.getLogger('catalogue')
+
+
+class Catalogue:
+    """ Class to describe a local full-text index of the NyaaTorrent torrents
+
+        The index is an SQLite database, the names of the torrents being indexed
+        with FTS5.
+
+        Attributes:
+            path (str): Path to the database.
+            connection (sqlite3.Connection): Connection to the database.
+
+        Args:
+            path (str): Path to the database, created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS torrents (
+                tid INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                timestamp REAL
+                );
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS torrents_index USING fts5(
+                name,
+                content='torrents',
+                content_rowid='tid'
+                );
+
+            CREATE TRIGGER IF NOT EXISTS torrents_insert AFTER INSERT ON torrents
+            BEGIN
+                INSERT INTO torrents_index(rowid, name)
+                VALUES (new.tid, new.name);
+            END;
+
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+                );
+            """)
+
+    @property
+    def synced(self):
+        """ Timestamp of the last synchronization, `None` if never synced
+        """
+        return self._get_meta('synced')
+
+    @property
+    def coverage(self):
+        """ Torrent IDs of the oldest and newest torrents of the range of
+            latest uploads indexed without gap, `None` if never synced
+
+            Any torrent uploaded between them is indexed.
+        """
+        oldest = self._get_meta('oldest')
+        newest = self._get_meta('newest')
+        if oldest is None or newest is None:
+            return None
+
+        return oldest, newest
+
+    def set_synced(self, timestamp, oldest, newest):
+        """ Record a synchronization with the website
+
+            Args:
+                timestamp (float): Timestamp of the synchronization.
+                oldest (int): Torrent ID of the oldest torrent of the range of
+                    latest uploads indexed without gap.
+                newest (int): Torrent ID of the newest torrent of this range.
+        """
+        with self.connection:
+            self.connection.executemany(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (
+                        ('synced', timestamp),
+                        ('oldest', oldest),
+                        ('newest', newest),
+                        )
+                    )
+
+    def _get_meta(self, key):
+        """ Get a value of the meta table
+
+            Args:
+                key (str): Key of the value.
+
+            Returns:
+                value, `None` if not set.
+        """
+        row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = ?",
+                (key,)
+                ).fetchone()
+
+        return row[0] if row else None
+
+    def add(self, torrents):
+        """ Add torrents to the index
+
+            Torrents already indexed are ignored.
+
+            Args:
+                torrents (list): list of torrent ID, name and upload timestamp
+                    of torrents.
+
+            Returns:
+                (int): amount of torrents not indexed before.
+        """
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                    "INSERT OR IGNORE INTO torrents VALUES (?, ?, ?)",
+                    ((int(tid), name, timestamp)
+                        for tid, name, timestamp in torrents)
+                    )
+
+            return self.connection.total_changes - before
+
+    def search(self, name, name_regex):
+        """ Search torrents by name
+
+            The index is searched for the literal words of the name, then the
+            results are filtered with the regex.
+
+            Args:
+                name (str): Querry string to search, where unpredictible parts
+                    are placeholders like `{garbage}`.
+                name_regex (str): Regex the whole name of the torrents must
+                    match.
+
+            Returns:
+                (list): list of torrent ID, match object and upload timestamp
+                of matching torrents, from the most recent.
+        """
+        terms = get_terms(name)
+        if terms:
+            rows = self.connection.execute(
+                    "SELECT torrents.tid, torrents.name, torrents.timestamp "
+                    "FROM torrents_index JOIN torrents "
+                    "ON torrents.tid = torrents_index.rowid "
+                    "WHERE torrents_index MATCH ? "
+                    "ORDER BY torrents.tid DESC",
+                    (" ".join(terms),)
+                    )
+
+        else:
+            rows = self.connection.execute(
+                    "SELECT tid, name, timestamp FROM torrents "
+                    "ORDER BY tid DESC"
+                    )
+
+        regex = re.compile(name_regex)
+        results = []
+        for tid, torrent_name, timestamp in rows:
+            match = regex.fullmatch(torrent_name)
+            if match is not None:
+                results.append((str(tid), match, timestamp))
+
+        return results
+
+
+def get_terms(name):
+    """ Get the full-text query terms of a querry string
+
+        Words followed by a placeholder are searched as prefixes, words
+        preceded by a placeholder are ignored, as they may be part of a longer
+        word in the torrent name.
+
+        Args:
+            name (str): Querry string.
+
+        Returns:
+            (list): query terms of the querry string, all of them must match.
+    """
+    parts = re.split(REGEX_PLACEHOLDER, name)
+    terms = []
+    for index, part in enumerate(parts):
+        for match in re.finditer(REGEX_WORD, part):
+            if index > 0 and match.start() == 0:
+                continue
+
+            term = '"{}"'.format(match.group(0))
+            if index < len(parts) - 1 and match.end() == len(part):
+                term += '*'
+
+            terms.append(term)
+
+    return terms
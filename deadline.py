@@ -0,0 +1,59 @@
+import time
+
+
+class Deadline:
+    """ Class to describe the deadline of a run
+
+        Attributes:
+            end (float): Time of the deadline, according to `time.monotonic`.
+                `None` if there is no deadline.
+
+        Args:
+            duration (float): Duration of the run in seconds, starting now.
+                There is no deadline if not set.
+    """
+
+    def __init__(self, duration=None):
+        if duration is None:
+            self.end = None
+
+        else:
+            self.end = time.monotonic() + duration
+
+    @property
+    def remaining(self):
+        """ Remaining time in seconds, `None` if there is no deadline
+        """
+        if self.end is None:
+            return None
+
+        return self.end - time.monotonic()
+
+    @property
+    def expired(self):
+        remaining = self.remaining
+        return remaining is not None and remaining <= 0
+
+    def get_timeout(self, connect, read):
+        """ Get the timeout of a request, limited by the deadline
+
+            Args:
+                connect (float): Connect timeout in seconds.
+                read (float): Read timeout in seconds.
+
+            Returns:
+                (tuple): connect and read timeouts in seconds.
+        """
+        remaining = self.remaining
+        if remaining is None:
+            return connect, read
+
+        if remaining <= 0:
+            raise DeadlineError("Run deadline reached")
+
+        return min(connect, remaining), min(read, remaining)
+
+
+class DeadlineError(Exception):
+    """ Class for reached deadline errors
+    """
@@ -0,0 +1,106 @@
+import zlib
+import fcntl
+import logging
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('lock')
+
+
+class RunLock:
+    """ Class to describe a lock shared by the runs of all shards
+
+        The lock is a single file, where byte 0 protects the state file and
+        each series has its own byte, held by the run handling it during the
+        whole run. So, two runs on the same series cannot overlap, whatever
+        their shards and their amounts of shards, while runs on different
+        series can.
+
+        Attributes:
+            path (str): Path to the lock file. `None` if there is no lock.
+            file (file): Lock file, opened while the lock is acquired.
+
+        Args:
+            path (str): Path to the lock file. Nothing is locked if not set.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.file = None
+
+    def acquire(self, names):
+        """ Acquire the lock for some series
+
+            Args:
+                names (list): Names of the series.
+        """
+        if self.path is None:
+            return
+
+        self.file = open(self.path, 'a')
+
+        for name in names:
+            try:
+                fcntl.lockf(
+                        self.file,
+                        fcntl.LOCK_EX | fcntl.LOCK_NB,
+                        1,
+                        get_offset(name)
+                        )
+
+            except OSError as error:
+                # closing the file releases the series locked so far
+                self.file.close()
+                self.file = None
+                raise LockError(
+                        "Another run is in progress for series '{}'".format(
+                            name
+                            )
+                        ) from error
+
+        logger.debug("Lock acquired on '{}'".format(self.path))
+
+    def release(self):
+        """ Release the lock
+        """
+        if self.file is None:
+            return
+
+        # closing the file releases all its locks
+        self.file.close()
+        self.file = None
+
+    @contextmanager
+    def hold_state(self):
+        """ Hold the lock of the state file, waiting for it if needed
+        """
+        if self.file is None:
+            yield
+            return
+
+        fcntl.lockf(self.file, fcntl.LOCK_EX, 1, 0)
+        try:
+            yield
+
+        finally:
+            fcntl.lockf(self.file, fcntl.LOCK_UN, 1, 0)
+
+
+def get_offset(name):
+    """ Get the byte of the lock file of a series
+
+        Two series may share the same byte, which only prevents their runs to
+        overlap.
+
+        Args:
+            name (str): Name of the series.
+
+        Returns:
+            (int): offset of the byte, byte 0 being reserved for the state file.
+    """
+    return zlib.crc32(name.encode('utf-8')) + 1
+
+
+class LockError(Exception):
+    """ Class for lock errors
+    """
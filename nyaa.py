@@ -2,11 +2,25 @@ import requests
 import urllib
 import re
 import html
+import time
+import calendar
+import threading
 import logging
+from collections import deque
+from concurrent import futures
+from stats import percentile
+from deadline import Deadline
+from catalogue import Catalogue
 
 
 REGEX_TID = r'tid=(\d+)'
 REGEX_NAME = r'<a href=".*?' + REGEX_TID + '">{name}</a>'
+REGEX_TIMESTAMP = r'data-timestamp="(\d+)"'
+REGEX_DATE = r'(\d{4}-\d{2}-\d{2}),? (\d{2}:\d{2}) UTC'
+
+
+# minimal amount of requests to a mirror to trust its latency percentile
+HEDGE_SAMPLES_MIN = 5
 
 
 logger = logging.getLogger('nyaa')
@@ -15,56 +29,176 @@ logger = logging.getLogger('nyaa')
 class NyaaConnector:
     """ Class to describe a connexion with the NyaaTorrent website
 
+        Each search is sent to the fastest healthy mirror of the website. If
+        hedging is enabled and this mirror does not respond within its usual
+        latency, the search is sent to the next mirror as well and the first
+        response is used. If a mirror fails, the next one is tried.
+
         Attributes:
-            scheme (str): HTTP or HTTPS connection.
-            host (str): the URL to NyaaTorent, without the scheme.
+            mirrors (list): List of `NyaaMirror`, the first one being the main
+                host.
+            hedge_percentile (float): Percentile of the latency of a mirror
+                after which the request is hedged. `None` if hedging is
+                disabled.
+            max_error_rate (float): Error rate above which a mirror is
+                considered unhealthy.
+            executor (concurrent.futures.Executor): Executor for hedged
+                requests.
+            session (requests.Session): HTTP session used for requests.
+            timestamps (dict): Upload timestamps of the torrents found, by
+                torrent ID.
+            timeout (tuple): connect and read timeouts of requests in seconds.
+            deadline (Deadline): deadline of the run, limiting the timeouts.
+            catalogue (Catalogue): local index of the torrents of the website.
+                `None` if searches are sent to the website.
+            catalogue_pages (int): Maximal amount of pages of latest uploads
+                to read when synchronizing the catalogue.
+            catalogue_max_age (float): Time in seconds after which the
+                catalogue is synchronized again.
+            sync_failed (float): Timestamp of the last failed synchronization
+                of the catalogue. `None` if none has failed.
 
         Args:
             host (str): Address of the NyaaTorrent website.
+            mirrors (str): Addresses of mirrors of the NyaaTorrent website,
+                separated by spaces or commas.
+            hedge_percentile (str): Percentile of the latency of a mirror
+                after which the request is hedged. Hedging is disabled if not
+                set.
+            max_error_rate (str): Error rate above which a mirror is considered
+                unhealthy. Set to 0.5 by default.
+            window (str): Amount of requests to a mirror to compute its latency
+                and error rate. Set to 20 by default.
+            session (requests.Session): HTTP session used for requests. A new
+                one is created by default.
+            connect_timeout (str): connect timeout of requests in seconds. Set
+                to 10 by default.
+            read_timeout (str): read timeout of requests in seconds. Set to 30
+                by default.
+            deadline (Deadline): deadline of the run, limiting the timeouts.
+                No deadline by default.
+            catalogue (str): Path to the local index of the torrents of the
+                website. If set, searches are answered by the index, which is
+                synchronized with the latest uploads of the website. Searches
+                are sent to the website otherwize.
+            catalogue_pages (str): Maximal amount of pages of latest uploads to
+                read when synchronizing the catalogue, the first
+                synchronization reads all of them. Torrents older than the
+                pages read are searched on the website. Set to 100 by default.
+            catalogue_max_age (str): Time in seconds after which the catalogue
+                is synchronized again. Set to 300 by default.
     """
 
-    def __init__(self, host=None):
+    def __init__(
+            self,
+            host=None,
+            mirrors='',
+            hedge_percentile=None,
+            max_error_rate='0.5',
+            window='20',
+            session=None,
+            connect_timeout='10',
+            read_timeout='30',
+            deadline=None,
+            catalogue=None,
+            catalogue_pages='100',
+            catalogue_max_age='300'
+            ):
         if host is None:
             raise NyaaConnectorError("Parameter 'host' missing in config file")
 
-        host_split = urllib.parse.urlsplit(host)
-        self.scheme = host_split[0]
-        self.host = host_split[1]
+        try:
+            window = int(window)
+            self.max_error_rate = float(max_error_rate)
+            self.timeout = (float(connect_timeout), float(read_timeout))
+            self.catalogue_pages = int(catalogue_pages)
+            self.catalogue_max_age = float(catalogue_max_age)
+            if hedge_percentile is not None:
+                hedge_percentile = float(hedge_percentile)
+
+        except ValueError as error:
+            raise NyaaConnectorError("Parameters 'window', 'max_error_rate', \
+'hedge_percentile', 'connect_timeout', 'read_timeout', 'catalogue_pages' and \
+'catalogue_max_age' must represent numbers") from error
+
+        if catalogue is not None:
+            catalogue = Catalogue(catalogue)
+
+        self.catalogue = catalogue
+
+        if deadline is None:
+            deadline = Deadline()
+
+        self.deadline = deadline
+
+        self.hedge_percentile = hedge_percentile
+        self.mirrors = [
+                NyaaMirror(address, window)
+                for address in [host] + re.split(r'[\s,]+', mirrors.strip())
+                if address
+                ]
+
+        if session is None:
+            session = requests.Session()
+
+        self.session = session
+        self.timestamps = {}
+        self.sync_failed = None
+        self.executor = futures.ThreadPoolExecutor(
+                max_workers=2 * len(self.mirrors)
+                )
+
+    def get_mirrors(self):
+        """ Get the mirrors from the most to the least suitable
+
+            Healthy mirrors come first, from the fastest to the slowest, then
+            unhealthy mirrors, from the least to the most failing.
+
+            Returns:
+                (list): list of `NyaaMirror`.
+        """
+        healthy = [m for m in self.mirrors
+                if m.error_rate <= self.max_error_rate]
+
+        unhealthy = [m for m in self.mirrors
+                if m.error_rate > self.max_error_rate]
 
-    def get_id_from_url(self, name):
+        return sorted(healthy, key=lambda m: m.latency) \
+                + sorted(unhealthy, key=lambda m: m.error_rate)
+
+    def get_id_from_url(self, name, previous=None):
         """ Get torrent ID from URL
 
+            If there is a catalogue, it is searched first. The website is only
+            searched if the torrent may be older than the torrents indexed,
+            that is if the previous torrent is not indexed.
+
             Args:
                 name (str): Querry string to search.
+                previous (str): Querry string of a torrent uploaded before the
+                    one searched, like the previous entry of a series.
 
             Returns:
                 (str): torrent ID. `None` if the name has not been found.
         """
-        name_term = name.format(garbage='*', variation='').encode(
-                'ascii',
-                errors='ignore'
-                )
+        if self.sync_catalogue():
+            results = self.catalogue.search(name, get_name_regex(name))
+            if results:
+                tid, _, timestamp = results[0]
+                logger.debug("Catalogue has responded one ID: {}".format(tid))
+                if timestamp is not None:
+                    self.timestamps[tid] = timestamp
 
-        url = urllib.parse.urlunsplit((
-                self.scheme,
-                self.host,
-                '',
-                urllib.parse.urlencode({
-                    'page': 'search',
-                    'term': name_term,
-                    }),
-                '',
-                ))
+                return tid
 
-        logger.debug("Requesting ID from name: '{}'".format(
-                    name_term.decode('ascii')
-                    ))
+            if self.is_catalogued(previous):
+                logger.debug("No ID found in catalogue")
+                return None
 
-        request = requests.get(url)
-        if not request.ok:
-            raise NyaaConnectorError(
-                    "Unable to connect to server: error {}".format(request.status_code)
-                    )
+            logger.debug("No ID found in catalogue, searching website")
+
+        name_term = name.format(garbage='*', variation='')
+        request = self._search(name_term)
 
         tid = re.findall(REGEX_TID, request.url)
         if not tid:
@@ -80,6 +214,7 @@ class NyaaConnector:
             return result
 
         logger.debug("Request has responded one ID: {}".format(tid[0]))
+        self._set_timestamp(tid[0], request.text)
         return tid[0]
 
     def get_id_from_page(self, page, name):
@@ -97,20 +232,371 @@ class NyaaConnector:
                 (str): torrent ID. `None` if the name has not been found.
         """
         page = html.unescape(page)
-        name_reg = re.escape(name)\
-                .replace('\\{variation\\}', '(?:v\d+)?')\
-                .replace('\\{garbage\\}', '.*?')
+        name_reg = get_name_regex(name)
 
         logger.debug("Searching ID in page from name: '{}'".format(name_reg))
         regex = re.compile(REGEX_NAME.format(name=name_reg))
-        tid = re.findall(regex, page)
-        if not tid:
+        match = regex.search(page)
+        if match is None:
             logger.debug("No ID found")
             return None
 
-        logger.debug("Found at least one ID: {}".format(tid[0]))
-        return tid[0]
+        tid = match.group(1)
+        logger.debug("Found at least one ID: {}".format(tid))
+
+        timestamp = get_row_timestamp(page, match)
+        if timestamp is not None:
+            self.timestamps[tid] = timestamp
+
+        return tid
+
+    def get_torrents_from_page(self, page):
+        """ Get all the torrents of a result page
+
+            Args:
+                page (str): HTML document, contains a list of results.
+
+            Returns:
+                (list): list of torrent ID, name and upload timestamp of the
+                torrents, the timestamp being `None` if unknown.
+        """
+        page = html.unescape(page)
+        return [
+                (match.group(1), match.group(2), get_row_timestamp(page, match))
+                for match in re.finditer(REGEX_NAME.format(name='(.*?)'), page)
+                ]
+
+    def is_catalogued(self, name):
+        """ Tell if a torrent is in the range of latest uploads indexed by the
+            catalogue
+
+            If so, any torrent uploaded after it is indexed as well.
+
+            Args:
+                name (str): Querry string of the torrent.
+
+            Returns:
+                (bool): `True` if the torrent is in the range.
+        """
+        coverage = self.catalogue.coverage
+        if name is None or coverage is None:
+            return False
+
+        oldest, _ = coverage
+        return any(
+                int(tid) >= oldest
+                for tid, _, _ in self.catalogue.search(
+                    name,
+                    get_name_regex(name)
+                    )
+                )
+
+    def sync_catalogue(self):
+        """ Synchronize the catalogue with the latest uploads of the website
+
+            Pages of latest uploads are read until a page reaches the range of
+            uploads indexed by the last synchronization, which is then
+            extended. If `catalogue_pages` pages are read before, the range
+            read replaces the range indexed. A failed synchronization does not
+            change the range, so the next one reads the missing pages again.
+            The catalogue is synchronized only if the last synchronization, or
+            the last failed one, is older than `catalogue_max_age`, searches
+            being sent to the website in the meantime after a failure.
+
+            Returns:
+                (bool): `True` if the catalogue can answer searches, `False` if
+                there is no catalogue or it could not be synchronized.
+        """
+        if self.catalogue is None:
+            return False
+
+        now = time.time()
+        synced = self.catalogue.synced
+        if synced is not None and now - synced < self.catalogue_max_age:
+            return True
+
+        if self.sync_failed is not None \
+                and now - self.sync_failed < self.catalogue_max_age:
+            return False
+
+        coverage = self.catalogue.coverage
+        oldest = newest = None
+        overlap = False
+        added = 0
+        try:
+            for offset in range(1, self.catalogue_pages + 1):
+                torrents = self.get_torrents_from_page(
+                        self._request({'offset': offset}).text
+                        )
+
+                added += self.catalogue.add(torrents)
+                if not torrents:
+                    break
+
+                # pages list the latest uploads first
+                tids = [int(tid) for tid, _, _ in torrents]
+                if newest is None:
+                    newest = max(tids)
+
+                oldest = min(tids)
+
+                if coverage is not None and oldest <= coverage[1]:
+                    overlap = True
+                    break
+
+        except NyaaConnectorError as error:
+            # a catalogue never synchronized cannot answer
+            logger.warning("Unable to synchronize catalogue\n{}".format(error))
+            self.sync_failed = now
+            return False
+
+        if overlap:
+            oldest, newest = coverage[0], max(newest, coverage[1])
+
+        elif newest is None and coverage is not None:
+            # nothing has been read
+            oldest, newest = coverage
+
+        self.catalogue.set_synced(now, oldest, newest)
+        self.sync_failed = None
+        logger.debug("Catalogue synchronized with {} new torrents".format(
+            added
+            ))
+
+        return True
+
+    def get_timestamp(self, tid):
+        """ Get the upload time of a torrent found
+
+            Args:
+                tid (str): Torrent ID.
+
+            Returns:
+                (float): upload timestamp. `None` if unknown.
+        """
+        return self.timestamps.get(tid)
+
+    def _set_timestamp(self, tid, text):
+        """ Set the upload time of a torrent from a part of a page
+
+            Args:
+                tid (str): Torrent ID.
+                text (str): Part of a page containing the upload time of the
+                    torrent only.
+        """
+        timestamp = parse_timestamp(text)
+        if timestamp is not None:
+            self.timestamps[tid] = timestamp
+
+    def get_batch_from_url(self, name, previous=None):
+        """ Get the torrent ID of the largest batch from URL
+
+            If there is a catalogue, it is searched first, as for
+            `get_id_from_url`.
+
+            Args:
+                name (str): Querry string to search. The number of the last
+                    entry of the batch is represented by `{last}`.
+                previous (str): Querry string of a torrent uploaded before the
+                    batch, like the entry preceding the batch.
+
+            Returns:
+                (tuple): torrent ID and number of the last entry of the batch.
+                `None` if no batch has been found.
+        """
+        if self.sync_catalogue():
+            results = self.catalogue.search(name, get_name_regex(name))
+            if results:
+                tid, match, timestamp = max(
+                        results,
+                        key=lambda result: int(result[1].group(1))
+                        )
+
+                logger.debug("Catalogue has responded one batch: {}".format(
+                    tid
+                    ))
+                if timestamp is not None:
+                    self.timestamps[tid] = timestamp
+
+                return tid, int(match.group(1))
+
+            if self.is_catalogued(previous):
+                logger.debug("No batch found in catalogue")
+                return None
+
+            logger.debug("No batch found in catalogue, searching website")
 
+        name_term = name.format(garbage='*', last='*')
+        request = self._search(name_term)
+        page = html.unescape(request.text)
+        name_reg = get_name_regex(name)
+
+        tid = re.findall(REGEX_TID, request.url)
+        if tid:
+            # the search has lead to the page of the torrent, the number of the
+            # last entry is in its title
+            last = re.findall(name_reg, page)
+            if not last:
+                logger.debug("No batch found")
+                return None
+
+            logger.debug("Request has responded one batch: {}".format(tid[0]))
+            self._set_timestamp(tid[0], page)
+            return tid[0], int(last[0])
+
+        return self.get_batch_from_page(page, name)
+
+    def get_batch_from_page(self, page, name):
+        """ Get the torrent ID of the largest batch from a result page
+
+            Args:
+                page (str): HTML document, contains a list of results.
+                name (str): Querry string to search. The number of the last
+                    entry of the batch is represented by `{last}`.
+
+            Returns:
+                (tuple): torrent ID and number of the last entry of the batch.
+                `None` if no batch has been found.
+        """
+        page = html.unescape(page)
+        name_reg = get_name_regex(name)
+
+        batches = re.findall(REGEX_NAME.format(name=name_reg), page)
+        if not batches:
+            logger.debug("No batch found")
+            return None
+
+        tid, last = max(batches, key=lambda batch: int(batch[1]))
+        logger.debug("Found at least one batch: {}".format(tid))
+        return tid, int(last)
+
+    def get_page_from_term(self, term):
+        """ Get the result page of a search
+
+            Args:
+                term (str): Term to search.
+
+            Returns:
+                (str): HTML document, contains a list of results ordered from
+                the most recent. `None` if the search has lead to a single
+                result.
+        """
+        request = self._search(term)
+        if re.findall(REGEX_TID, request.url):
+            logger.debug("Request has responded one ID, no result page")
+            return None
+
+        return request.text
+
+    def _search(self, name_term):
+        """ Send a search request
+
+            Args:
+                name_term (str): Term to search.
+
+            Returns:
+                (requests.Response): response of the website, which has been
+                redirected to the torrent page if there is only one result.
+        """
+        name_term = name_term.encode('ascii', errors='ignore')
+
+        logger.debug("Requesting ID from name: '{}'".format(
+                    name_term.decode('ascii')
+                    ))
+
+        return self._request({
+            'page': 'search',
+            'term': name_term,
+            })
+
+    def _request(self, query):
+        """ Send a request to the most suitable mirrors
+
+            Args:
+                query (dict): Query of the request.
+
+            Returns:
+                (requests.Response): response of the first mirror to succeed.
+        """
+        mirrors = self.get_mirrors()
+        requests_sent = []
+        error = None
+
+        # hedge the request only if the latency of the mirror is known
+        delay = None
+        if self.hedge_percentile is not None and len(mirrors) > 1 \
+                and mirrors[0].samples >= HEDGE_SAMPLES_MIN:
+            delay = mirrors[0].get_percentile(self.hedge_percentile)
+
+        if delay is not None:
+            requests_sent.append(self.executor.submit(
+                self._request_mirror,
+                mirrors[0],
+                query
+                ))
+
+            done, _ = futures.wait(requests_sent, timeout=delay)
+            if not done:
+                logger.debug("Hedging request to '{}'".format(mirrors[1]))
+                requests_sent.append(self.executor.submit(
+                    self._request_mirror,
+                    mirrors[1],
+                    query
+                    ))
+
+            for request_sent in futures.as_completed(requests_sent):
+                try:
+                    return request_sent.result()
+
+                except NyaaConnectorError as request_error:
+                    error = request_error
+
+        # try the remaining mirrors one after another
+        for mirror in mirrors[len(requests_sent):]:
+            try:
+                return self._request_mirror(mirror, query)
+
+            except NyaaConnectorError as request_error:
+                error = request_error
+
+        raise error
+
+    def _request_mirror(self, mirror, query):
+        """ Send a request to a mirror and record its latency
+
+            Args:
+                mirror (NyaaMirror): Mirror to send the request to.
+                query (dict): Query of the request.
+
+            Returns:
+                (requests.Response): response of the mirror.
+        """
+        start = time.monotonic()
+        try:
+            request = self.session.get(
+                    mirror.get_url(query),
+                    timeout=self.deadline.get_timeout(*self.timeout)
+                    )
+
+        except requests.exceptions.RequestException as error:
+            mirror.record(time.monotonic() - start, error=True)
+            logger.debug("Unable to connect to '{}'".format(mirror))
+            raise NyaaConnectorError("Unable to connect to server '{}'".format(
+                mirror
+                )) from error
+
+        mirror.record(time.monotonic() - start, error=not request.ok)
+        if not request.ok:
+            logger.debug("Error {} from '{}'".format(
+                request.status_code,
+                mirror
+                ))
+
+            raise NyaaConnectorError(
+                    "Unable to connect to server: error {}".format(request.status_code)
+                    )
+
+        return request
 
     def get_url_from_id(self, tid):
         """ Get the torrent URL from the torrent ID
@@ -121,18 +607,173 @@ class NyaaConnector:
             Returns:
                 (str): URL of the torrent on the NyaaTorrent website.
         """
-        url = urllib.parse.urlunsplit((
+        return self.get_mirrors()[0].get_url({
+            'page': 'download',
+            'tid': tid,
+            })
+
+
+class NyaaMirror:
+    """ Class to describe a mirror of the NyaaTorrent website and its health
+
+        Attributes:
+            scheme (str): HTTP or HTTPS connection.
+            host (str): the URL to NyaaTorent, without the scheme.
+            latencies (collections.deque): Latencies of the last requests, in
+                seconds.
+            errors (collections.deque): Flags of failure of the last requests.
+            lock (threading.Lock): Lock for the records, as hedged requests
+                may finish in other threads.
+
+        Args:
+            host (str): Address of the mirror.
+            window (int): Amount of requests to compute the latency and the
+                error rate.
+    """
+
+    def __init__(self, host, window):
+        host_split = urllib.parse.urlsplit(host)
+        self.scheme = host_split[0]
+        self.host = host_split[1]
+        self.latencies = deque(maxlen=window)
+        self.errors = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    @property
+    def latency(self):
+        """ Mean latency, 0 if the mirror has not been requested yet
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+
+        if latencies:
+            return sum(latencies) / len(latencies)
+
+        return 0
+
+    @property
+    def samples(self):
+        """ Amount of successful requests recorded
+        """
+        with self.lock:
+            return len(self.latencies)
+
+    @property
+    def error_rate(self):
+        with self.lock:
+            errors = list(self.errors)
+
+        if errors:
+            return sum(errors) / len(errors)
+
+        return 0
+
+    def get_percentile(self, rank):
+        """ Get a percentile of the latency
+
+            Args:
+                rank (float): Percentile to compute.
+
+            Returns:
+                (float): latency in seconds.
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+
+        return percentile(latencies, rank)
+
+    def record(self, latency, error=False):
+        """ Record the result of a request
+
+            Args:
+                latency (float): Latency of the request, in seconds.
+                error (bool): Flag for failure of the request.
+        """
+        with self.lock:
+            # latency of failed requests is not representative
+            if not error:
+                self.latencies.append(latency)
+
+            self.errors.append(error)
+
+    def get_url(self, query):
+        """ Get the URL of a page of the mirror
+
+            Args:
+                query (dict): Query of the page.
+
+            Returns:
+                (str): URL of the page.
+        """
+        return urllib.parse.urlunsplit((
                 self.scheme,
                 self.host,
                 '',
-                urllib.parse.urlencode({
-                    'page': 'download',
-                    'tid': tid,
-                    }),
+                urllib.parse.urlencode(query),
                 '',
                 ))
 
-        return url
+    def __str__(self):
+        return self.host
+
+
+def get_row_timestamp(page, match):
+    """ Get the upload time in the row of a result
+
+        Args:
+            page (str): HTML document, contains a list of results.
+            match (re.Match): Match of the result in the document.
+
+        Returns:
+            (float): upload timestamp. `None` if not found.
+    """
+    row_start = page.rfind('<tr', 0, match.start())
+    row_end = page.find('</tr>', match.end())
+    row = page[max(row_start, 0):row_end if row_end >= 0 else None]
+
+    return parse_timestamp(row)
+
+
+def parse_timestamp(text):
+    """ Get the first upload time of a part of a page
+
+        The upload time is given either as a timestamp attribute, or as a UTC
+        date like `2016-03-12, 17:00 UTC`, as on the page of a torrent.
+
+        Args:
+            text (str): Part of a page.
+
+        Returns:
+            (float): upload timestamp. `None` if not found.
+    """
+    timestamp = re.search(REGEX_TIMESTAMP, text)
+    if timestamp:
+        return float(timestamp.group(1))
+
+    date = re.search(REGEX_DATE, text)
+    if date:
+        return float(calendar.timegm(time.strptime(
+            "{} {}".format(*date.groups()),
+            "%Y-%m-%d %H:%M"
+            )))
+
+    return None
+
+
+def get_name_regex(name):
+    """ Convert a querry string to a regex
+
+        Args:
+            name (str): Querry string to search.
+
+        Returns:
+            (str): regex matching the name. If the name contains `{last}`, the
+            regex has one group for this number.
+    """
+    return re.escape(name)\
+            .replace('\\{variation\\}', '(?:v\d+)?')\
+            .replace('\\{garbage\\}', '.*?')\
+            .replace('\\{last\\}', '(\d+)')
 
 
 class NyaaConnectorError(Exception):
@@ -2,14 +2,22 @@
 
 import sys
 import os
+import time
+import zlib
 import logging
 import argparse
 import getpass
 from configparser import ConfigParser
 import requests
-from series import Series, SeriesError
+from series import Series, SeriesError, STATUS_COMPLETED
 from nyaa import NyaaConnector, NyaaConnectorError
-from transmission import TransmissionConnector, TransmissionConnectorError
+from transmission import TransmissionConnector, TransmissionConnectorError, \
+        TransmissionQueue
+from cassette import RecordingSession, ReplayingSession, CassetteError
+from deadline import Deadline, DeadlineError
+from state import State
+from lock import RunLock, LockError
+from server import create_server
 
 
 __VERSION__ = "0.1.0"
@@ -21,6 +29,7 @@ CONFIG_SERIES = 'SERIES'
 CONFIG_TRANSMISSION = 'TRANSMISSION'
 CONFIG_NYAA = 'NYAA'
 CONFIG_LOGS = 'LOGS'
+SERVER_ADDRESS = '127.0.0.1:8421'
 
 
 logger = logging.getLogger('nyaa_mission')
@@ -44,9 +53,27 @@ class NyaaMission:
                 Transmission server. If not defined, it takes the value of
                 `directory_local`.
             series (list): list of the series to update.
+            series_due (list): list of the series to check on NyaaTorrent during
+                this run, completed series and stale series checked recently
+                are excluded.
+            state (State): state kept between runs.
+            shard (tuple): index starting from 1 and amount of shards, the
+                series of other shards are ignored. `None` if there is no
+                sharding.
+            lock (RunLock): lock shared by all runs, held on the series of this
+                run.
+            server_address (str): address to listen to for notifications in
+                server mode, either `host:port` or `unix:/path/to/socket`.
+            queue (TransmissionQueue): limits on the load of the Transmission
+                server, new entries are held in the pending entries of their
+                series while they are exceeded. `None` if there are no limits.
             transmission (TransmissionConnector): connector to the Transmission
                 server.
             nyaa (NyaaConnector): connector to the NyaaTorrent website.
+            group_search (bool): Flag to search the latest uploads of release
+                groups shared by several series once for all of them.
+            session (requests.Session): HTTP session used by the connectors.
+            deadline (Deadline): deadline of the run.
 
         Args:
             config_path (str): Path to the config file.
@@ -55,17 +82,31 @@ class NyaaMission:
                 directories.
             dry_run (bool): Flag to perform a dry run, wher no files will be set
                 for dowloading.
+            session (requests.Session): HTTP session used by the connectors,
+                used to record or replay HTTP interactions. Each connector
+                creates its own by default.
+            deadline (float): Duration of the run in seconds, after which the
+                remaining series are skipped. No deadline by default.
+            shard (tuple): index starting from 1 and amount of shards, to only
+                handle the series of this shard. All series are handled by
+                default.
     """
     def __init__(
             self,
             config_path=None,
             config_series_path=None,
             skip_directory_check=False,
-            dry_run=False
+            dry_run=False,
+            session=None,
+            deadline=None,
+            shard=None
             ):
 
         self.skip_directory_check = skip_directory_check
         self.dry_run = dry_run
+        self.session = session
+        self.deadline = Deadline(deadline)
+        self.shard = shard
 
         # manage config files names
         if config_path is None:
@@ -103,6 +144,21 @@ class NyaaMission:
         self.series = []
         self.set_series(series_config)
 
+        # lock, to avoid concurrent runs on the same series
+        self.lock = RunLock(config.get('State', 'lock', fallback=None))
+        self.lock.acquire([s.name for s in self.series])
+
+        # server mode
+        self.server_address = config.get('Server', 'address',
+                fallback=SERVER_ADDRESS)
+
+        # state
+        self.state = State(config.get('State', 'file', fallback=None))
+        for series in self.series:
+            series.set_state(self.state.get_series(series.name))
+
+        self.series_due = list(self.series)
+
         # transmission
         if "Transmission" not in config:
             raise NyaaMissionConfigError(
@@ -111,6 +167,12 @@ class NyaaMission:
 
         self.set_transmission(config['Transmission'])
 
+        if "Queue" in config:
+            self.queue = TransmissionQueue(self.transmission, **config['Queue'])
+
+        else:
+            self.queue = None
+
         # nyaatorrent
         if "Nyaa" not in config:
             raise NyaaMissionConfigError(
@@ -130,6 +192,10 @@ class NyaaMission:
             if name == 'DEFAULT':
                 continue
 
+            if self.shard is not None and get_shard(name, self.shard[1]) \
+                    != self.shard[0]:
+                continue
+
             self.series.append(Series(
                 name,
                 directory_local_prefix=self.directory_local,
@@ -160,6 +226,8 @@ class NyaaMission:
         self.transmission = TransmissionConnector(
                 login=login,
                 password=password,
+                session=self.session,
+                deadline=self.deadline,
                 **config
                 )
 
@@ -172,31 +240,172 @@ class NyaaMission:
                 config (configparser.SectionProxy): Dictionnary of parameters
                     for connection to the  NyaaTorrent website.
         """
-        self.nyaa = NyaaConnector(**config)
+        self.group_search = config.getboolean('group_search', fallback=False)
+        config.pop('group_search', None)
+
+        self.nyaa = NyaaConnector(
+                session=self.session,
+                deadline=self.deadline,
+                **config
+                )
+
+    def get_group_pages(self):
+        """ Search the latest uploads of release groups shared by series
+
+            Only one search is sent for all the series of a same release
+            group, series alone in their group are not concerned.
+
+            Returns:
+                (dict): HTML document listing the latest uploads, by release
+                group.
+        """
+        series_amount = {}
+        for series in self.series_due:
+            if series.group is not None:
+                series_amount[series.group] = \
+                        series_amount.get(series.group, 0) + 1
+
+        group_pages = {}
+        for group, amount in series_amount.items():
+            if amount < 2:
+                continue
+
+            logger.debug("Searching latest uploads of '{}' for {} series".format(
+                group,
+                amount
+                ))
 
-    def refresh(self):
+            page = self.nyaa.get_page_from_term(group)
+            if page is not None:
+                group_pages[group] = page
+
+        return group_pages
+
+    def refresh(self, series=None):
         """ Browse files and Transmission for downloaded or downloading torrents
+
+            Only the series due for a check are browsed. When the deadline of
+            the run is reached, entries are left incomplete, so all the series
+            due are skipped by the update.
+
+            Args:
+                series (list): Series to browse, whether they are due or not,
+                    except completed series. All series due by default.
         """
-        torrents = self.transmission.get_all_torrents()
-        for series in self.series:
-            series.entries = []
-            if not self.skip_directory_check:
-                series.set_entries_from_directory()
+        now = time.time()
+        if series is None:
+            self.series_due = [s for s in self.series if s.is_due(now)]
+
+        else:
+            self.series_due = [s for s in series
+                    if s.get_status(now) != STATUS_COMPLETED]
+
+        logger.debug("{} series due for check, {} series skipped".format(
+            len(self.series_due),
+            len(self.series) - len(self.series_due)
+            ))
+
+        try:
+            for series in self.series_due:
+                if self.deadline.expired:
+                    raise DeadlineError("Run deadline reached")
+
+                series.entries = []
+                if not self.skip_directory_check:
+                    series.set_entries_from_directory()
+
+            # torrents are streamed from the server and dispatched to each
+            # series as they arrive, so the whole list is never kept in memory
+            for torrent in self.transmission.iter_torrents():
+                for series in self.series_due:
+                    series.set_entry_from_torrent(torrent)
 
-            series.set_entries_from_transmission(torrents)
+        except (DeadlineError, TransmissionConnectorError):
+            # errors caused by the deadline are not fatal
+            if not self.deadline.expired:
+                raise
 
-    def update(self):
+            logger.debug("Deadline reached while browsing entries")
+            return
+
+        for series in self.series_due:
+            series.clean_pending()
+
+    def update(self, series_run=None):
         """ Check new series episodes in NyaaTorrent website
+
+            When the deadline of the run is reached, the remaining series are
+            skipped, requests still running cannot last longer as their timeouts
+            are limited by the deadline. Entries already sent
+            to the Transmission server are kept. The state of the series checked
+            is saved in any case.
+
+            If the load of the Transmission server is limited, new entries are
+            held and pending entries of all series are released as long as the
+            server can accept them.
+
+            Series found completed when browsing their entries are not checked.
+
+            Args:
+                series_run (list): Series handled by the run, the only ones
+                    whose pending entries are released and whose state is
+                    saved. All series by default.
+
+            Returns:
+                (list): series skipped because of the deadline.
         """
-        for series in self.series:
+        skipped = []
+
+        # completion is only known once the entries have been browsed
+        now = time.time()
+        for series in self.series_due:
+            if series.get_status(now) == STATUS_COMPLETED:
+                logger.debug("Series '{}' completed".format(series))
+                series.set_checked(now)
+
+        self.series_due = [s for s in self.series_due
+                if s.get_status(now) != STATUS_COMPLETED]
+
+        try:
+            group_pages = self.get_group_pages() if self.group_search else {}
+
+        except (DeadlineError, NyaaConnectorError):
+            if not self.deadline.expired:
+                raise
+
+            group_pages = {}
+
+        for series in self.series_due:
+            if self.deadline.expired:
+                skipped.append(series)
+                continue
+
             old_max = series.max_number
-            series.set_new_entries_from_nyaa(self.nyaa)
-            series.download_new_entries(
-                    self.nyaa,
-                    self.transmission,
-                    self.dry_run
-                    )
+            try:
+                series.set_new_entries_from_nyaa(
+                        self.nyaa,
+                        group_pages.get(series.group)
+                        )
+                if self.queue is None:
+                    series.download_new_entries(
+                            self.nyaa,
+                            self.transmission,
+                            self.dry_run
+                            )
+
+                else:
+                    series.set_new_entries_pending()
+
+            except (DeadlineError, NyaaConnectorError,
+                    TransmissionConnectorError):
+                # errors caused by the deadline are not fatal
+                if not self.deadline.expired:
+                    raise
+
+                skipped.append(series)
+                continue
 
+            series.set_checked(time.time())
             new_max = series.max_number
             amount = new_max - old_max
             if amount:
@@ -206,6 +415,190 @@ class NyaaMission:
                     "ies" if amount > 1 else "y"
                     ))
 
+        if self.queue is not None and not self.deadline.expired:
+            try:
+                self.release_pending(series_run)
+
+            except (DeadlineError, TransmissionConnectorError):
+                if not self.deadline.expired:
+                    raise
+
+        # a dry run does not change anything for next runs
+        if not self.dry_run:
+            self.save_state(series_run)
+
+        self.log_freshness()
+
+        if skipped:
+            logger.warning("Deadline reached, {} series skipped: {}".format(
+                len(skipped),
+                ", ".join(str(series) for series in skipped)
+                ))
+
+        return skipped
+
+    def check(self, series):
+        """ Check some series at once, outside of regular runs
+
+            Used by the server mode when a notification is received. The lock is
+            held on these series during the check, and their state is read
+            again, as other runs may have changed it since.
+
+            Args:
+                series (list): Series to check.
+
+            Returns:
+                (int): amount of new entries.
+        """
+        self.lock.acquire([s.name for s in series])
+        try:
+            self.state = State(self.state.path)
+            for s in series:
+                s.set_state(self.state.get_series(s.name))
+
+            self.refresh(series)
+            old_max = {s.name: s.max_number for s in self.series_due}
+            self.update(series_run=series)
+
+            return sum(s.max_number - old_max[s.name] for s in self.series_due)
+
+        finally:
+            self.lock.release()
+
+    def release_pending(self, series=None):
+        """ Send pending entries to the Transmission server
+
+            Entries are sent by order of number, as long as the server can
+            accept them. The entries of a batch are sent at once. The capacity
+            of the server is read once per run, so entries are released at
+            most once per run, not as soon as the server can accept them.
+            Torrents the server refuses do not use its capacity.
+
+            Args:
+                series (list): Series whose pending entries are released. All
+                    series by default.
+        """
+        if series is None:
+            series = self.series
+
+        pending = [e for s in series for e in s.pending]
+        if not pending:
+            return
+
+        capacity = self.queue.get_capacity()
+        pending.sort(key=lambda e: (e.number, e.parent.name))
+
+        # status of the torrents already sent, by torrent ID
+        requested = {}
+        released = 0
+        for entry in pending:
+            if entry.tid not in requested:
+                if capacity is not None and released >= capacity:
+                    continue
+
+                if not self.dry_run:
+                    requested[entry.tid] = self.transmission.add_torrent(
+                            directory=entry.parent.directory_server,
+                            torrent_url=self.nyaa.get_url_from_id(entry.tid)
+                            )
+
+                    if requested[entry.tid]:
+                        entry.parent.record_latency(entry, time.time())
+
+                else:
+                    requested[entry.tid] = True
+
+                if requested[entry.tid]:
+                    released += 1
+
+            if requested[entry.tid]:
+                entry.parent.release_pending_entry(entry)
+
+        remaining = sum(len(s.pending) for s in series)
+        logger.info("Released {} pending torrent{}, {} entr{} still \
+pending".format(
+            released,
+            "s" if released > 1 else "",
+            remaining,
+            "ies" if remaining > 1 else "y"
+            ))
+
+    def log_freshness(self):
+        """ Log the delay between the upload of entries and their addition to
+            the Transmission server for the series checked
+        """
+        for series in self.series_due:
+            freshness = series.get_freshness()
+            if freshness is None:
+                continue
+
+            logger.info("Freshness {}: p50 {:.1f} min, p95 {:.1f} min over {} \
+torrent{}".format(
+                series,
+                freshness[0] / 60,
+                freshness[1] / 60,
+                len(series.latencies),
+                "s" if len(series.latencies) > 1 else ""
+                ))
+
+    def save_state(self, series=None):
+        """ Save the state of the series for next runs
+
+            Args:
+                series (list): Series whose state is saved. All series by
+                    default.
+        """
+        if series is None:
+            series = self.series
+
+        for s in series:
+            self.state.set_series(s.name, s.get_state())
+
+        # other shards may save the state file at the same time
+        with self.lock.hold_state():
+            self.state.save()
+
+
+def get_shard(name, amount):
+    """ Get the shard of a series
+
+        The shard only depends on the name of the series, so all processes agree
+        on it.
+
+        Args:
+            name (str): Name of the series.
+            amount (int): Amount of shards.
+
+        Returns:
+            (int): index of the shard, starting from 1.
+    """
+    return zlib.crc32(name.encode('utf-8')) % amount + 1
+
+
+def parse_shard(shard):
+    """ Parse a shard from the command line
+
+        Args:
+            shard (str): Shard in the form `i/n`.
+
+        Returns:
+            (tuple): index starting from 1 and amount of shards.
+    """
+    try:
+        index, amount = (int(value) for value in shard.split('/'))
+
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+                "Shard must be in the form 'i/n'"
+                ) from error
+
+    if not 1 <= index <= amount:
+        raise argparse.ArgumentTypeError(
+                "Shard index must be between 1 and the amount of shards"
+                )
+
+    return index, amount
+
 
 class NyaaMissionError(Exception):
     """ Class for general NyaaMission errors
@@ -252,23 +645,93 @@ if __name__ == '__main__':
             action='store_true'
             )
 
+    parser.add_argument(
+            "--deadline",
+            help="duration of the run in seconds, after which remaining \
+series are skipped",
+            type=float
+            )
+
+    parser.add_argument(
+            "--serve",
+            help="after the run, listen to notifications to check single \
+series, the deadline only applies to the first run",
+            action='store_true'
+            )
+
+    parser.add_argument(
+            "--shard",
+            help="only handle the series of the shard i among n shards, series \
+being split by name",
+            metavar="i/n",
+            type=parse_shard
+            )
+
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+            "--record",
+            help="record all HTTP interactions of the run in a cassette file",
+            metavar="CASSETTE"
+            )
+
+    cassette_group.add_argument(
+            "--replay",
+            help="replay HTTP interactions from a cassette file instead of \
+connecting to the servers",
+            metavar="CASSETTE"
+            )
+
+    parser.add_argument(
+            "--replay-latency",
+            help="wait for the recorded latency of each replayed interaction",
+            action='store_true'
+            )
+
     args = parser.parse_args()
 
+    session = None
     try:
+        if args.record:
+            session = RecordingSession(args.record)
+
+        elif args.replay:
+            session = ReplayingSession(args.replay, args.replay_latency)
+
         logger.info("NyaaMission v" + __VERSION__ + " started")
         nyaa_mission = NyaaMission(
                 config_path=args.config_file,
                 config_series_path=args.series_file,
                 skip_directory_check=args.skip_directory_check,
-                dry_run=args.dry_run
+                dry_run=args.dry_run,
+                session=session,
+                deadline=args.deadline,
+                shard=args.shard
                 )
 
         nyaa_mission.refresh()
         nyaa_mission.update()
+
+        if args.serve:
+            # the lock is only held during checks
+            nyaa_mission.lock.release()
+            nyaa_mission.deadline.end = None
+
+            server = create_server(nyaa_mission, nyaa_mission.server_address)
+            try:
+                server.serve_forever()
+
+            except KeyboardInterrupt:
+                server.server_close()
+
         logger.info("Closing")
 
-    except (SeriesError, TransmissionConnectorError, NyaaConnectorError) as error:
+    except (SeriesError, TransmissionConnectorError, NyaaConnectorError,
+            CassetteError, DeadlineError, LockError) as error:
         logger.critical("An error has occured\n{}".format(error))
 
     except:
         logger.exception("An error has occured")
+
+    finally:
+        if isinstance(session, RecordingSession):
+            session.save()
@@ -1,7 +1,21 @@
 import glob
 import os
 import re
+import time
 import logging
+from stats import percentile
+
+
+REGEX_GROUP = r'^\[[^\]]+\]'
+
+STATUS_ACTIVE = 'active'
+STATUS_STALE = 'stale'
+STATUS_COMPLETED = 'completed'
+
+DAY = 24 * 60 * 60
+
+# amount of latencies kept for freshness metrics
+LATENCIES_MAX = 100
 
 
 logger = logging.getLogger('series')
@@ -16,8 +30,10 @@ class Series:
             number_format (str): Format string for the number of the series. It
                 is aimed for setting the amount of zeros when querrying files.
             entries (list): List of series entries. The list is appended by
-                `set_entries_from_directory` and
-                `set_entries_from_transmission`.
+                `set_entries_from_directory` and `set_entry_from_torrent`.
+            pending (list): List of new series entries held until the
+                Transmission server can accept them. The list is kept between
+                runs.
             directory_local (str): Path to the directory of the series in the
                 local disk.
             directory_server (str): Path to the directory of the series in the
@@ -28,7 +44,32 @@ class Series:
                 entry file name with number formatting.
             max_ahead (int): Amount of files to dowload past the more recent
                 dowloaded.
-            max_number (int): Latest entry number.
+            max_number (int): Latest entry number, pending entries included.
+            regex_torrent (re.Pattern): Compiled regex matching the torrent
+                names of the series entries, the first group being the number.
+            batch_pattern_format (str): String pattern representing a batch
+                of series entries with formatted first number. `None` if
+                batches are not looked for.
+            regex_batch (re.Pattern): Compiled regex matching the torrent names
+                of the batches, the groups being the first and last numbers.
+                `None` if batches are not looked for.
+            batch_min (int): Minimal amount of entries in a batch to prefer it
+                over single entries.
+            group (str): Search term shared by series of a same release group.
+                `None` if the series belongs to no group.
+            episodes (int): Total amount of entries. `None` if unknown.
+            stale_after (float): Time in seconds without new entry after which
+                the series is stale. `None` if the series never gets stale.
+            stale_interval (float): Time in seconds between two checks of a
+                stale series.
+            last_number (int): Latest entry number known by previous runs.
+            last_release (float): Timestamp of the last time a new entry has
+                been found.
+            last_check (float): Timestamp of the last check of the series on
+                NyaaTorrent.
+            latencies (list): Latest delays in seconds between the upload of an
+                entry on NyaaTorrent and its addition to the Transmission
+                server, from the oldest.
 
         Args:
             name (str): Name of the series.
@@ -48,6 +89,21 @@ class Series:
             max_ahead (str): Amount of series to querry in one run. If set to
                 `all` or a negative number, all series entries will be
                 dowloaded.
+            batch_pattern (str): Pattern string to query a batch of series
+                entries, where the numbers of the first and last entries are
+                represented by `{first}` and `{last}`. Batches are not looked
+                for if not set.
+            batch_min (str): Minimal amount of entries in a batch to prefer it
+                over single entries. Set to 4 by default.
+            group (str): Search term shared by series of a same release group.
+                Set to the leading bracketed part of `pattern` by default, like
+                `[DameDesuYo]`.
+            episodes (str): Total amount of entries, after which the series is
+                completed and not checked anymore.
+            stale_after (str): Amount of days without new entry after which the
+                series is stale. The series never gets stale if not set.
+            stale_interval (str): Amount of days between two checks of a stale
+                series. Set to 7 by default.
     """
 
     def __init__(
@@ -59,7 +115,13 @@ class Series:
             directory_server_prefix='',
             pattern=None,
             number_format='02',
-            max_ahead='5'
+            max_ahead='5',
+            batch_pattern=None,
+            batch_min='4',
+            group=None,
+            episodes=None,
+            stale_after=None,
+            stale_interval='7'
             ):
         """ Constructor
 
@@ -68,6 +130,7 @@ class Series:
         self.number_format = number_format
 
         self.entries = []
+        self.pending = []
 
         # manage all optionnal arguments
         # directory on disk
@@ -100,6 +163,63 @@ class Series:
                 garbage='{garbage}'
                 )
 
+        # regex of the torrent names of the series items
+        # compiled once, as it is tested against every torrent of the server
+        self.regex_torrent = re.compile(re.escape(self.file_pattern)\
+                .replace('\\{number\\}', '(\d+)')\
+                .replace('\\{garbage\\}', '.*?')\
+                .replace('\\{variation\\}', '(?:v\d+)?')
+                )
+
+        # pattern of the batches of series items
+        if batch_pattern is not None:
+            self.batch_pattern_format = batch_pattern.format(
+                    first='{first:' + number_format + 'n}',
+                    last='{last}',
+                    garbage='{garbage}'
+                    )
+
+            self.regex_batch = re.compile(re.escape(batch_pattern)\
+                    .replace('\\{first\\}', '(\d+)')\
+                    .replace('\\{last\\}', '(\d+)')\
+                    .replace('\\{garbage\\}', '.*?')
+                    )
+
+        else:
+            self.batch_pattern_format = None
+            self.regex_batch = None
+
+        try:
+            self.batch_min = int(batch_min)
+
+        except ValueError as error:
+            raise SeriesError("Parameter 'batch_min' must represent \
+a digit") from error
+
+        # release group, guessed from the pattern
+        if group is None:
+            match = re.match(REGEX_GROUP, pattern)
+            if match is not None:
+                group = match.group(0)
+
+        self.group = group
+
+        # archiving
+        try:
+            self.episodes = int(episodes) if episodes is not None else None
+            self.stale_after = float(stale_after) * DAY \
+                    if stale_after is not None else None
+            self.stale_interval = float(stale_interval) * DAY
+
+        except ValueError as error:
+            raise SeriesError("Parameters 'episodes', 'stale_after' and \
+'stale_interval' must represent numbers") from error
+
+        self.last_number = 0
+        self.last_release = None
+        self.last_check = None
+        self.latencies = []
+
         # number of files to query
         # allowing spectial value `all`
         if max_ahead == 'all':
@@ -108,18 +228,169 @@ class Series:
         try:
             self.max_ahead = int(max_ahead)
 
-        except ValeError as error:
+        except ValueError as error:
             raise SeriesError("Parameter 'max_ahead' must represent \
 a digit or 'all'") from error
 
     @property
     def max_number(self):
-        if self.entries:
-            return max(e.number for e in self.entries)
+        if self.entries or self.pending:
+            return max(e.number for e in self.entries + self.pending)
 
         return 0
 
 
+    def match(self, title):
+        """ Tell if a torrent belongs to the series
+
+            Args:
+                title (str): Name of the torrent.
+
+            Returns:
+                (bool): `True` if the torrent is an entry or a batch of entries
+                of the series.
+        """
+        if self.regex_torrent.search(title):
+            return True
+
+        return self.regex_batch is not None \
+                and self.regex_batch.search(title) is not None
+
+    def get_status(self, now):
+        """ Get the status of the series
+
+            A series is completed when its last entry is known, it is stale
+            when no new entry has been found for `stale_after`, it is active
+            otherwize.
+
+            Args:
+                now (float): Current timestamp.
+
+            Returns:
+                (str): status of the series.
+        """
+        if self.episodes is not None \
+                and max(self.max_number, self.last_number) >= self.episodes:
+            return STATUS_COMPLETED
+
+        if self.stale_after is not None and self.last_release is not None \
+                and now - self.last_release > self.stale_after:
+            return STATUS_STALE
+
+        return STATUS_ACTIVE
+
+    def is_due(self, now):
+        """ Tell if the series has to be checked on NyaaTorrent
+
+            Active series are always checked, stale series are checked every
+            `stale_interval`, completed series are never checked.
+
+            Args:
+                now (float): Current timestamp.
+
+            Returns:
+                (bool): `True` if the series has to be checked.
+        """
+        status = self.get_status(now)
+        if status == STATUS_COMPLETED:
+            return False
+
+        if status == STATUS_STALE:
+            return self.last_check is None \
+                    or now - self.last_check >= self.stale_interval
+
+        return True
+
+    def set_state(self, state):
+        """ Set the values kept from previous runs
+
+            Args:
+                state (dict): Values kept from previous runs.
+        """
+        self.last_number = state.get('last_number', 0)
+        self.last_release = state.get('last_release')
+        self.last_check = state.get('last_check')
+        self.latencies = state.get('latencies', [])
+        self.pending = [
+                SeriesEntry(
+                    number=entry['number'],
+                    file_name=entry['file_name'],
+                    tid=entry['tid'],
+                    published=entry.get('published'),
+                    parent=self
+                    )
+                for entry in state.get('pending', [])
+                ]
+
+    def get_state(self):
+        """ Get the values to keep for next runs
+
+            Returns:
+                (dict): Values to keep for next runs.
+        """
+        return {
+                'last_number': self.last_number,
+                'last_release': self.last_release,
+                'last_check': self.last_check,
+                'latencies': self.latencies,
+                'pending': [
+                    {
+                        'number': entry.number,
+                        'file_name': entry.file_name,
+                        'tid': entry.tid,
+                        'published': entry.published,
+                        }
+                    for entry in self.pending
+                    ],
+                }
+
+    def set_checked(self, now):
+        """ Record a check of the series on NyaaTorrent
+
+            Args:
+                now (float): Current timestamp.
+        """
+        self.last_check = now
+
+        # entries which could not be added to the Transmission server are not
+        # counted, so they are looked for again next run
+        numbers = [e.number for e in self.entries
+                if e.downloaded or e.downloading]
+        numbers += [e.number for e in self.pending]
+        kept_number = max(numbers, default=0)
+
+        # the first check starts the count for staleness
+        if kept_number > self.last_number or self.last_release is None:
+            self.last_release = now
+
+        self.last_number = max(kept_number, self.last_number)
+
+    def record_latency(self, entry, now):
+        """ Record the delay between the upload of an entry and its addition to
+            the Transmission server
+
+            Args:
+                entry (SeriesEntry): Entry added to the Transmission server.
+                now (float): Timestamp of the addition.
+        """
+        if entry.published is None:
+            return
+
+        self.latencies.append(now - entry.published)
+        del self.latencies[:-LATENCIES_MAX]
+
+    def get_freshness(self):
+        """ Get the median and 95th percentile of the latest latencies
+
+            Returns:
+                (tuple): median and 95th percentile in seconds. `None` if no
+                latency has been recorded.
+        """
+        if not self.latencies:
+            return None
+
+        return percentile(self.latencies, 50), percentile(self.latencies, 95)
+
     def set_entries_from_directory(self):
         """ Set series entries by walking in the directory for downloaded entries
         """
@@ -165,32 +436,33 @@ a digit or 'all'") from error
 
                 self.entries.append(new_entry)
 
-    def set_entries_from_transmission(self, torrents):
-        """ Set series entries from the Tranimission server
+    def set_entry_from_torrent(self, torrent):
+        """ Set a series entry from a torrent of the Transmission server
 
-            The server has already been asked for the torrent list.
+            Used to dispatch torrents to series one at a time, while they are
+            streamed from the server.
 
             Args:
-                torrents (list): The list of all torrents in the server.
+                torrent (str): Name of the torrent.
         """
-        if not torrents:
-            logger.debug("No torrents to look in")
-            return
-
-        regex_number = re.escape(self.file_pattern)\
-                .replace('\\{number\\}', '(\d+)')\
-                .replace('\\{garbage\\}', '.*?')\
-                .replace('\\{variation\\}', '(?:v\d+)?')
+        # many torrents don't correspond to the ones of the series
+        # we need a simple way to pass them
+        match = self.regex_torrent.search(torrent)
+        if match is not None:
+            numbers = [int(match.group(1))]
+
+        elif self.regex_batch is not None:
+            match = self.regex_batch.search(torrent)
+            if match is None:
+                return
 
-        for torrent in torrents:
-            try:
-                # many torrents don't correspond to the ones of the series
-                # we need a simple way to pass them
-                number = int(re.findall(regex_number, torrent)[0])
+            # every entry of the batch is counted as present
+            numbers = range(int(match.group(1)), int(match.group(2)) + 1)
 
-            except IndexError:
-                continue
+        else:
+            return
 
+        for number in numbers:
             new_entry = SeriesEntry(
                 number=number,
                 file_name=torrent,
@@ -205,17 +477,55 @@ a digit or 'all'") from error
 
                 self.entries.append(new_entry)
 
-    def set_new_entries_from_nyaa(self, nyaa_connector):
+    def get_entry_name(self, number):
+        """ Get the querry string of an entry
+
+            Args:
+                number (int): Number of the entry.
+
+            Returns:
+                (str): querry string, with formatted number.
+        """
+        return self.file_pattern_format.format(
+                number=number,
+                variation='{variation}',
+                garbage='{garbage}'
+                )
+
+    def set_new_entries_from_nyaa(self, nyaa_connector, group_page=None):
         """ Query NyaaTorrent to get now series entries
 
             Set maximum `max_ahead` new series entries by asking the NyaaTorrent
-            website.
+            website. When `batch_min` new entries have been found, or
+            `max_ahead` is reached before, the series is far behind and a batch
+            starting right after the old latest entry is looked for. If found,
+            it replaces the single entries it contains and counts as one entry
+            in `max_ahead`.
+
+            If the page of the latest uploads of the release group is given,
+            entries are looked for in it first. As this page lists the most
+            recent uploads first, it contains any entry newer than an entry it
+            contains, and the website is not asked in this case.
 
             Args:
                 nyaa_connector (NyaaConnector): Connector for the NyaaTorrent
                     website.
+                group_page (str): HTML document listing the latest uploads of
+                    the release group of the series.
         """
         old_max_number = self.max_number
+        group_page_complete = group_page is not None \
+                and old_max_number > 0 \
+                and nyaa_connector.get_id_from_page(
+                        group_page,
+                        self.get_entry_name(old_max_number)
+                        ) is not None
+
+        # amount of new entries to find before looking for a batch
+        batch_threshold = self.batch_min if self.max_ahead <= 0 \
+                else min(self.batch_min, self.max_ahead)
+
+        number = old_max_number + 1
         i = 0
         condition_fun = (
                 # always loop if max_ahead is null or negative
@@ -226,14 +536,25 @@ a digit or 'all'") from error
                         )
 
         while condition_fun(i):
-            number = old_max_number + i + 1
-            name = self.file_pattern_format.format(
-                    number=number,
-                    variation='{variation}',
-                    garbage='{garbage}'
-                    )
+            # the series is completed
+            if self.episodes is not None and number > self.episodes:
+                logger.debug("Last entry reached for '{}'".format(self))
+                break
+
+            name = self.get_entry_name(number)
+
+            tid = None
+            if group_page is not None:
+                tid = nyaa_connector.get_id_from_page(group_page, name)
+                if tid:
+                    group_page_complete = True
+
+            if not tid and not group_page_complete:
+                tid = nyaa_connector.get_id_from_url(
+                        name,
+                        self.get_entry_name(number - 1) if number > 1 else None
+                        )
 
-            tid = nyaa_connector.get_id_from_url(name)
             if not tid:
                 logger.debug("Finished looking new entries for \
 '{}'".format(self))
@@ -246,6 +567,7 @@ a digit or 'all'") from error
                 number=number,
                 file_name=name,
                 tid=tid,
+                published=nyaa_connector.get_timestamp(tid),
                 parent=self
                 # this entry is neither dowloaded, nor downloading, so it as to
                 # be sent to Transmission by download_new_entries
@@ -258,6 +580,113 @@ a digit or 'all'") from error
 
             # update iterator
             i += 1
+            number += 1
+
+            if self.batch_pattern_format is not None and i == batch_threshold \
+                    and self.set_new_batch_from_nyaa(
+                            nyaa_connector,
+                            old_max_number + 1,
+                            group_page
+                            ):
+                # the batch counts as one entry
+                i = 1
+                number = self.max_number + 1
+
+    def set_new_batch_from_nyaa(self, nyaa_connector, first, group_page=None):
+        """ Query NyaaTorrent to get a batch of new series entries
+
+            The batch must start at the given entry and contain at least
+            `batch_min` entries, all of them are set as new entries, replacing
+            the new single entries they contain.
+
+            Args:
+                nyaa_connector (NyaaConnector): Connector for the NyaaTorrent
+                    website.
+                first (int): Number of the first entry of the batch.
+                group_page (str): HTML document listing the latest uploads of
+                    the release group of the series, looked into first.
+
+            Returns:
+                (bool): `True` if a batch has been found, `False` otherwize.
+        """
+        name = self.batch_pattern_format.format(
+                first=first,
+                last='{last}',
+                garbage='{garbage}'
+                )
+
+        batch = None
+        if group_page is not None:
+            batch = nyaa_connector.get_batch_from_page(group_page, name)
+
+        if batch is None:
+            batch = nyaa_connector.get_batch_from_url(
+                    name,
+                    self.get_entry_name(first - 1) if first > 1 else None
+                    )
+
+        if batch is None:
+            return False
+
+        tid, last = batch
+        if last - first + 1 < self.batch_min:
+            logger.debug("Batch too small for '{}'".format(self))
+            return False
+
+        self.entries = [e for e in self.entries
+                if e.downloaded or e.downloading
+                or not first <= e.number <= last]
+
+        for number in range(first, last + 1):
+            self.entries.append(SeriesEntry(
+                number=number,
+                file_name=name.format(last=last, garbage='{garbage}'),
+                tid=tid,
+                published=nyaa_connector.get_timestamp(tid),
+                parent=self
+                ))
+
+        logger.debug("Adding new batch {}-{} for '{}'".format(
+            first,
+            last,
+            self
+            ))
+
+        return True
+
+    def set_new_entries_pending(self):
+        """ Hold the new series entries until the Transmission server can
+            accept them
+
+            New entries are entries neither downloaded nor downloading, they are
+            moved to the pending entries.
+        """
+        for entry in list(self.entries):
+            if not (entry.downloaded or entry.downloading):
+                logger.debug("Set entry '{}' pending".format(entry))
+                self.entries.remove(entry)
+                self.pending.append(entry)
+
+    def clean_pending(self):
+        """ Remove pending entries already downloaded or downloading
+
+            This happens when the entry has been added to the Transmission
+            server by other means.
+        """
+        numbers = set(e.number for e in self.entries)
+        self.pending = [e for e in self.pending if e.number not in numbers]
+
+    def release_pending_entry(self, entry):
+        """ Set a pending entry as downloading
+
+            Args:
+                entry (SeriesEntry): Pending entry sent to the Transmission
+                    server.
+        """
+        logger.debug("Set entry '{}' to download".format(entry))
+        self.pending.remove(entry)
+        entry.downloading = True
+        self.entries.append(entry)
 
     def download_new_entries(
             self,
@@ -268,7 +697,8 @@ a digit or 'all'") from error
         """ Dowload the new series entries
 
             Ask the Transmission server to start download the new entries, which
-            are entries neither downloaded nor downloading.
+            are entries neither downloaded nor downloading. Entries sharing the
+            same batch torrent are requested only once.
 
             Args:
                 nyaa_connector (NyaaTorrent): Connector for the NyaaTorrent
@@ -279,17 +709,26 @@ a digit or 'all'") from error
                     to add torrents to the Transmission server is not sent and
                     no files are dowloaded. Set to `False` by default.
         """
+        # status of the torrents already requested, by torrent ID
+        requested = {}
         for entry in self.entries:
             if not (entry.downloaded or entry.downloading):
-                if not dry_run:
+                if entry.tid in requested:
+                    downloading = requested[entry.tid]
+
+                elif not dry_run:
                     downloading = transmission_connector.add_torrent(
                             directory=self.directory_server,
                             torrent_url=nyaa_connector.get_url_from_id(entry.tid)
                             )
 
+                    if downloading:
+                        self.record_latency(entry, time.time())
+
                 else:
                     downloading = True
 
+                requested[entry.tid] = downloading
                 if downloading:
                     logger.debug("Set entry '{}' to download".format(entry))
                     entry.downloading = True
@@ -314,6 +753,8 @@ class SeriesEntry:
                 the episode is currently being dowladed and is currently in the
                 Transmission server torrent list.
             tid (str): Torrent ID in the NyaaTorrent website.
+            published (float): Upload timestamp of the episode in the
+                NyaaTorrent website. `None` if unknown.
             parent (Series): series the episode belongs to.
     """
     def __init__(
@@ -323,6 +764,7 @@ class SeriesEntry:
             downloaded=False,
             downloading=False,
             tid='',
+            published=None,
             parent=None,
             ):
 
@@ -331,12 +773,16 @@ class SeriesEntry:
         self.downloaded = downloaded
         self.downloading = downloading
         self.tid = tid
+        self.published = published
         self.parent = parent
 
     def __eq__(self, other):
         """ Test equality of two episodes
+
+            Episodes of a same batch share the same file name.
         """
-        return self.file_name == other.file_name
+        return self.file_name == other.file_name \
+                and self.number == other.number
 
     def __ne__(self, other):
         """ Test inequality of two episodes
@@ -0,0 +1,138 @@
+import os
+import json
+import socketserver
+import logging
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from series import SeriesError
+from nyaa import NyaaConnectorError
+from transmission import TransmissionConnectorError
+from lock import LockError
+
+
+PREFIX_UNIX = 'unix:'
+
+
+logger = logging.getLogger('server')
+
+
+class NyaaMissionRequestHandler(BaseHTTPRequestHandler):
+    """ Class to handle notifications sent to the server
+
+        Two notifications are accepted:
+            `POST /check?series=<name>` checks the series with this name;
+            `POST /upload?title=<title>` checks the series the uploaded torrent
+            with this title belongs to.
+
+        Parameters can be given in the query string or as a form in the body.
+    """
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        parameters = parse_qs(url.query)
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            parameters.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+        nyaa_mission = self.server.nyaa_mission
+
+        if url.path == '/check' and 'series' in parameters:
+            names = parameters['series']
+            series = [s for s in nyaa_mission.series if s.name in names]
+
+        elif url.path == '/upload' and 'title' in parameters:
+            titles = parameters['title']
+            series = [s for s in nyaa_mission.series
+                    if any(s.match(title) for title in titles)]
+
+        else:
+            self._respond(400, {'error': "Unknown notification"})
+            return
+
+        if not series:
+            self._respond(404, {'error': "No series concerned"})
+            return
+
+        try:
+            amount = nyaa_mission.check(series)
+
+        except LockError as error:
+            self._respond(503, {'error': str(error)})
+            return
+
+        except (SeriesError, TransmissionConnectorError,
+                NyaaConnectorError) as error:
+            logger.error("Unable to check series\n{}".format(error))
+            self._respond(500, {'error': str(error)})
+            return
+
+        self._respond(200, {
+            'series': [s.name for s in series],
+            'new_entries': amount,
+            })
+
+    def _respond(self, status, content):
+        """ Send a JSON response
+
+            Args:
+                status (int): HTTP status of the response.
+                content (dict): Content of the response.
+        """
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        if not self.client_address:
+            return PREFIX_UNIX
+
+        return super().address_string()
+
+    def log_message(self, format, *args):
+        logger.debug("{} {}".format(self.address_string(), format % args))
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """ Class for an HTTP server listening on a Unix socket
+    """
+
+    def server_bind(self):
+        # remove the socket left by a previous server
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+        super().server_bind()
+
+
+def create_server(nyaa_mission, address):
+    """ Create a server to receive notifications
+
+        Notifications are handled one at a time.
+
+        Args:
+            nyaa_mission (NyaaMission): Session to check series with.
+            address (str): Address to listen to, either `host:port` or
+                `unix:/path/to/socket`.
+
+        Returns:
+            (socketserver.BaseServer): server, to run with `serve_forever`.
+    """
+    if address.startswith(PREFIX_UNIX):
+        server = UnixHTTPServer(
+                address[len(PREFIX_UNIX):],
+                NyaaMissionRequestHandler
+                )
+
+    else:
+        host, port = address.rsplit(':', 1)
+        server = HTTPServer((host, int(port)), NyaaMissionRequestHandler)
+
+    server.nyaa_mission = nyaa_mission
+    logger.info("Listening to notifications on '{}'".format(address))
+
+    return server
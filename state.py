@@ -0,0 +1,86 @@
+import os
+import json
+import logging
+
+
+logger = logging.getLogger('state')
+
+
+class State:
+    """ Class to describe the state kept between runs
+
+        The state is stored as a JSON file, with one dictionary of values per
+        series.
+
+        Attributes:
+            path (str): Path to the state file. `None` if the state is not kept
+                between runs.
+            series (dict): State of each series, by series name.
+            changed (set): Names of the series whose state has been set by
+                this run.
+
+        Args:
+            path (str): Path to the state file. The state is not kept between
+                runs if not set.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.series = self._load()
+        self.changed = set()
+
+        logger.debug("Loaded state of {} series".format(len(self.series)))
+
+    def _load(self):
+        """ Read the state file
+
+            Returns:
+                (dict): state of each series, by series name.
+        """
+        if self.path is None or not os.path.isfile(self.path):
+            return {}
+
+        with open(self.path) as file:
+            return json.load(file).get('series', {})
+
+    def get_series(self, name):
+        """ Get the state of a series
+
+            Args:
+                name (str): Name of the series.
+
+            Returns:
+                (dict): state of the series, empty if unknown.
+        """
+        return self.series.get(name, {})
+
+    def set_series(self, name, state):
+        """ Set the state of a series
+
+            Args:
+                name (str): Name of the series.
+                state (dict): State of the series.
+        """
+        self.series[name] = state
+        self.changed.add(name)
+
+    def save(self):
+        """ Write the state file
+
+            The file is replaced at once, so an interrupted run cannot leave a
+            partial file. Only the state of series set by this run is written,
+            the state of other series, handled by other shards, is kept.
+        """
+        if self.path is None:
+            return
+
+        series = self._load()
+        for name in self.changed:
+            series[name] = self.series[name]
+
+        path_tmp = self.path + '.tmp'
+        with open(path_tmp, 'w') as file:
+            json.dump({'series': series}, file, indent=1, sort_keys=True)
+
+        os.replace(path_tmp, self.path)
+        logger.debug("Saved state in '{}'".format(self.path))
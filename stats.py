@@ -0,0 +1,19 @@
+import math
+
+
+def percentile(values, rank):
+    """ Compute a percentile with the nearest-rank method
+
+        Args:
+            values (iterable): Values to compute the percentile of.
+            rank (float): Percentile to compute, between 0 and 100.
+
+        Returns:
+            (float): value of the percentile. `None` if there are no values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+
+    index = max(math.ceil(rank / 100 * len(values)) - 1, 0)
+    return values[index]
@@ -1,11 +1,17 @@
 import urllib
+import os
 import re
+import json
+import codecs
 import requests
 import logging
+from deadline import Deadline, DeadlineError
 
 
 TOKEN = 'X-Transmission-Session-Id'
 REGEX_TOKEN = r'<code>' + TOKEN + ': (.*?)</code>'
+REGEX_TORRENTS = r'"torrents"\s*:\s*\['
+CHUNK_SIZE = 64 * 1024
 
 
 logger = logging.getLogger('transmission')
@@ -21,6 +27,11 @@ class TransmissionConnector:
             host (str): Address of the Transmission server RTC API.
             credentials (tuple): login and password for authetication on the
                 Transmission server.
+            session (requests.Session): HTTP session used for requests.
+            timeout (tuple): connect and read timeouts of requests in seconds.
+            deadline (Deadline): deadline of the run, limiting the timeouts.
+            token_file (str): Path to the file sharing the token between
+                processes. `None` if the token is not shared.
 
         Args:
             host (str): Address of the Transmission server RTC API.
@@ -30,14 +41,53 @@ class TransmissionConnector:
                 Transmission server.
             ssl_verify (bool): check the validity of the SSL certificate. Set to
                 `True` by default.
+            session (requests.Session): HTTP session used for requests. A new
+                one is created by default.
+            connect_timeout (str): connect timeout of requests in seconds. Set
+                to 10 by default.
+            read_timeout (str): read timeout of requests in seconds. Set to 60
+                by default.
+            deadline (Deadline): deadline of the run, limiting the timeouts.
+                No deadline by default.
+            token_file (str): Path to the file sharing the token between
+                processes. The token is not shared if not set.
     """
 
-    def __init__(self, host, login, password, ssl_verify=True):
+    def __init__(
+            self,
+            host,
+            login,
+            password,
+            ssl_verify=True,
+            session=None,
+            connect_timeout='10',
+            read_timeout='60',
+            deadline=None,
+            token_file=None
+            ):
         self.token = None
         self.ssl_verify = ssl_verify
         self.host = host
         self.credentials = (login, password)
 
+        if session is None:
+            session = requests.Session()
+
+        self.session = session
+
+        try:
+            self.timeout = (float(connect_timeout), float(read_timeout))
+
+        except ValueError as error:
+            raise TransmissionConnectorError("Parameters 'connect_timeout' \
+and 'read_timeout' must represent numbers") from error
+
+        if deadline is None:
+            deadline = Deadline()
+
+        self.deadline = deadline
+        self.token_file = token_file
+
     def token_required(fun):
         """ Decorator for authentification
         """
@@ -61,12 +111,19 @@ class TransmissionConnector:
 
     def set_token(self):
         """ Authenticate on server and set token
+
+            If the token is shared, the token of the file is used without
+            authenticating. It is renewed automatically when it expires.
         """
-        request = requests.get(
-                self.host,
-                auth=self.credentials,
-                verify=self.ssl_verify
-                )
+        if self.token_file is not None and os.path.isfile(self.token_file):
+            with open(self.token_file) as file:
+                self.token = file.read().strip()
+
+            if self.token:
+                logger.debug("Use shared token of Transmission server")
+                return
+
+        request = self._request('get')
 
         if request.ok:
             return
@@ -76,7 +133,7 @@ class TransmissionConnector:
         if request.status_code == 409:
             token = re.findall(REGEX_TOKEN, request.text)
             if token:
-                self.token = token[0]
+                self._update_token(token[0])
 
                 logger.debug("Conected to Transmission server with token")
                 return
@@ -89,6 +146,25 @@ server failed: wrong login or password")
         raise TransmissionConnectorError("Unable to connect to Transmission \
 server: error {}".format(request.status_code))
 
+    def _update_token(self, token):
+        """ Set a new token and share it
+
+            Args:
+                token (str): New token.
+        """
+        self.token = token
+
+        if self.token_file is None:
+            return
+
+        # the file is replaced at once, so other processes never read a partial
+        # token
+        token_file_tmp = "{}.{}".format(self.token_file, os.getpid())
+        with open(token_file_tmp, 'w') as file:
+            file.write(token)
+
+        os.replace(token_file_tmp, self.token_file)
+
     @token_required
     def add_torrent(self, directory, torrent_url):
         """ Set a torrent in queue
@@ -98,8 +174,8 @@ server: error {}".format(request.status_code))
                 url (str): URL of the torrent to add.
 
             Returns:
-                (bool): status of dowload request. `True` if it was successful,
-                `False` otherwize.
+                (bool): status of dowload request. `True` if it was successful
+                or if the torrent was already on the server, `False` otherwize.
         """
         data = {
                 'method': 'torrent-add',
@@ -109,13 +185,7 @@ server: error {}".format(request.status_code))
                     },
                 }
 
-        request = requests.post(
-                self.host,
-                json=data,
-                auth=self.credentials,
-                headers=self._get_authentication_header(),
-                verify=self.ssl_verify
-                )
+        request = self._post(data)
 
         if not request.ok:
             raise TransmissionConnectorError(
@@ -127,15 +197,24 @@ server: error {}".format(request.status_code))
             logger.debug("Torrent sucessfuly added to download")
             return True
 
+        # the torrent is already downloading or downloaded
+        if 'arguments' in result and 'torrent-duplicate' in result['arguments']:
+            logger.debug("Torrent already added to download")
+            return True
+
         return False
 
     @token_required
-    def get_all_torrents(self):
-        """ Get all torrents currently in queue or finished
+    def iter_torrents(self):
+        """ Iterate over all torrents currently in queue or finished
 
-            Returns:
-                (list): list of all the torrents in the Transmission server.
-                Returns `None` if the list is empty. Or if something went wrong?
+            The response of the server is decoded incrementally, one torrent at
+            a time, so the memory used does not depend on the amount of
+            torrents. As the read timeout only limits each read, the deadline
+            is checked between reads, so a slow response cannot outlive it.
+
+            Yields:
+                (str): name of a torrent in the Transmission server.
         """
         data = {
                 'method': 'torrent-get',
@@ -146,29 +225,320 @@ server: error {}".format(request.status_code))
                     },
                 }
 
-        request = requests.post(
-                self.host,
-                json=data,
-                auth=self.credentials,
-                headers=self._get_authentication_header(),
-                verify=self.ssl_verify
-                )
+        request = self._post(data, stream=True)
+
+        try:
+            if not request.ok:
+                raise TransmissionConnectorError(
+                        "Unable to get torrents: error {}".format(
+                            request.status_code
+                            )
+                        )
+
+            amount = 0
+            for torrent in iter_json_array(
+                    iter_content_until(request, self.deadline),
+                    REGEX_TORRENTS
+                    ):
+                amount += 1
+                yield torrent['name']
+
+            logger.debug("Get stream of {} torrents".format(amount))
+
+        except requests.exceptions.RequestException as error:
+            raise TransmissionConnectorError("Unable to get torrents: \
+connection lost") from error
+
+        finally:
+            request.close()
+
+    def get_session_stats(self):
+        """ Get the statistics of the current session
+
+            Returns:
+                (dict): statistics of the session, like the amount of active
+                torrents `activeTorrentCount` and the download speed in B/s
+                `downloadSpeed`.
+        """
+        return self._call('session-stats')
+
+    def get_download_dir(self):
+        """ Get the default download directory of the server
+
+            Returns:
+                (str): path to the directory, as seen by the server.
+        """
+        return self._call('session-get')['download-dir']
 
+    def get_free_space(self, path):
+        """ Get the free space of a directory
+
+            Args:
+                path (str): Path to the directory, as seen by the server.
+
+            Returns:
+                (int): free space in bytes.
+        """
+        return self._call('free-space', {'path': path})['size-bytes']
+
+    def _call(self, method, arguments=None):
+        """ Call an RPC method of the server
+
+            Args:
+                method (str): Name of the method.
+                arguments (dict): Arguments of the method.
+
+            Returns:
+                (dict): arguments of the response.
+        """
+        data = {'method': method}
+        if arguments is not None:
+            data['arguments'] = arguments
+
+        request = self._post(data)
         if not request.ok:
             raise TransmissionConnectorError(
-                    "Unable to get torrents: error ".format(request.status_code)
+                    "Unable to call '{}': error {}".format(
+                        method,
+                        request.status_code
+                        )
                     )
 
         result = request.json()
-        if 'arguments' in result \
-                and 'torrents' in result['arguments'] \
-                and result['arguments']['torrents']:
+        if result.get('result') != 'success' or 'arguments' not in result:
+            raise TransmissionConnectorError("Unable to call '{}': {}".format(
+                method,
+                result.get('result')
+                ))
+
+        return result['arguments']
+
+    def _request(self, method, **kwargs):
+        """ Send a request to the server
+
+            Args:
+                method (str): HTTP method of the request.
+                Other keyword arguments are passed to the session.
+
+            Returns:
+                (requests.Response): response of the server.
+        """
+        try:
+            return self.session.request(
+                    method,
+                    self.host,
+                    auth=self.credentials,
+                    verify=self.ssl_verify,
+                    timeout=self.deadline.get_timeout(*self.timeout),
+                    **kwargs
+                    )
+
+        except requests.exceptions.RequestException as error:
+            raise TransmissionConnectorError("Unable to connect to \
+Transmission server: {}".format(error)) from error
+
+    @token_required
+    def _post(self, data, stream=False):
+        """ Send an authenticated RPC request to the server
+
+            Args:
+                data (dict): RPC request.
+                stream (bool): Flag to stream the response. Set to `False` by
+                    default.
+
+            Returns:
+                (requests.Response): response of the server.
+        """
+        request = self._request(
+                'post',
+                json=data,
+                headers=self._get_authentication_header(),
+                stream=stream
+                )
+
+        # the token has expired or has been renewed by the server, the new
+        # token is given in the headers of the 409 response
+        if request.status_code == 409 and TOKEN in request.headers:
+            request.close()
+            self._update_token(request.headers[TOKEN])
+            logger.debug("Token of Transmission server renewed")
+
+            request = self._request(
+                    'post',
+                    json=data,
+                    headers=self._get_authentication_header(),
+                    stream=stream
+                    )
+
+        return request
+
+
+def iter_content_until(request, deadline):
+    """ Iterate over the content of a streamed response until the deadline
+
+        Args:
+            request (requests.Response): Streamed response.
+            deadline (Deadline): Deadline after which the response is not read
+                anymore.
+
+        Yields:
+            (bytes): raw chunks of the response.
+    """
+    for chunk in request.iter_content(CHUNK_SIZE):
+        if deadline.expired:
+            raise DeadlineError("Run deadline reached while reading response")
+
+        yield chunk
+
+
+def iter_json_array(chunks, regex_array):
+    """ Decode incrementally the items of a JSON array
+
+        Only the items of the array are decoded, the rest of the document is
+        skipped. At most one item is kept in memory at a time.
+
+        Args:
+            chunks (iterable): raw chunks of the JSON document, as bytes.
+            regex_array (str): regex matching the beginning of the array, up to
+                its opening bracket included.
+
+        Yields:
+            the items of the array.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    regex_array = re.compile(regex_array)
+    buffer = ''
+    in_array = False
+    finished = False
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+
+        if not in_array:
+            match = regex_array.search(buffer)
+            if not match:
+                # keep the end of the buffer in case the beginning of the array
+                # is split between two chunks
+                buffer = buffer[-64:]
+                continue
+
+            buffer = buffer[match.end():]
+            in_array = True
+
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                finished = True
+                break
+
+            try:
+                item, end = decoder.raw_decode(buffer)
+
+            except ValueError:
+                # the item is not complete yet, wait for the next chunk
+                break
+
+            # an item is complete only when followed by a delimiter, as a
+            # scalar split between two chunks is decoded without error
+            rest = buffer[end:].lstrip()
+            if not rest:
+                break
+
+            if rest[0] not in ',]':
+                raise TransmissionConnectorError("Unable to get torrents: \
+malformed response")
+
+            buffer = rest
+            yield item
+
+        if finished:
+            return
+
+    if in_array:
+        raise TransmissionConnectorError("Unable to get torrents: \
+truncated response")
+
+
+class TransmissionQueue:
+    """ Class to describe the limits on the load of the Transmission server
+
+        New torrents are held while a limit is exceeded.
+
+        Attributes:
+            transmission (TransmissionConnector): Connector for the
+                Transmission server.
+            max_active (int): Maximal amount of active torrents. `None` if not
+                limited.
+            max_download_speed (int): Download speed in B/s above which new
+                torrents are held. `None` if not limited.
+            min_free_space (int): Free space in bytes of the download
+                directory under which new torrents are held. `None` if not
+                limited.
+
+        Args:
+            transmission (TransmissionConnector): Connector for the
+                Transmission server.
+            max_active (str): Maximal amount of active torrents. Not limited if
+                not set.
+            max_download_speed (str): Download speed in kB/s above which new
+                torrents are held. Not limited if not set.
+            min_free_space (str): Free space in MB of the download directory
+                under which new torrents are held. Not limited if not set.
+    """
+
+    def __init__(
+            self,
+            transmission,
+            max_active=None,
+            max_download_speed=None,
+            min_free_space=None
+            ):
+        self.transmission = transmission
+
+        try:
+            self.max_active = int(max_active) \
+                    if max_active is not None else None
+            self.max_download_speed = int(max_download_speed) * 1000 \
+                    if max_download_speed is not None else None
+            self.min_free_space = int(min_free_space) * 1000 ** 2 \
+                    if min_free_space is not None else None
+
+        except ValueError as error:
+            raise TransmissionConnectorError("Parameters 'max_active', \
+'max_download_speed' and 'min_free_space' must represent digits") from error
+
+    def get_capacity(self):
+        """ Get the amount of torrents the server can accept now
+
+            Returns:
+                (int): amount of torrents. `None` if not limited.
+        """
+        if self.min_free_space is not None:
+            free_space = self.transmission.get_free_space(
+                    self.transmission.get_download_dir()
+                    )
+
+            if free_space < self.min_free_space:
+                logger.debug("Not enough free space: {} B".format(free_space))
+                return 0
+
+        if self.max_active is None and self.max_download_speed is None:
+            return None
+
+        stats = self.transmission.get_session_stats()
+        if self.max_download_speed is not None \
+                and stats['downloadSpeed'] > self.max_download_speed:
+            logger.debug("Download speed too high: {} B/s".format(
+                stats['downloadSpeed']
+                ))
+
+            return 0
 
-            torrents = [t['name'] for t in result['arguments']['torrents']]
-            logger.debug("Get list of {} torrents".format(len(torrents)))
-            return torrents
+        if self.max_active is None:
+            return None
 
-        return None
+        return max(self.max_active - stats['activeTorrentCount'], 0)
 
 
 class TransmissionConnectorError(Exception):